@@ -7,227 +7,324 @@ Usage:
 Run this script on the EC2 instance (or copy it there) with root privileges (sudo) for --apply.
 """
 
-import subprocess
 import sys
 import os
 import argparse
+import asyncio
+import functools
+import http.client
+import io
+import shlex
+import shutil
+import subprocess
 from pathlib import Path
 
+_INDEX_HTML = '''<!DOCTYPE html>
+<html>
+<head>
+    <title>Apache Test Page</title>
+</head>
+<body>
+    <h1>Apache Web Server is Running!</h1>
+    <p>Congratulations! Your Apache web server is successfully installed and running on Amazon Linux 2023.</p>
+    <p>Server time: <script>document.write(new Date());</script></p>
+</body>
+</html>'''
+
+@functools.cache
+def _is_root():
+    """Whether the process runs with an effective UID of 0 (checked once)"""
+    return os.geteuid() == 0
+
+@functools.lru_cache(maxsize=1)
+def _system_release():
+    """Contents of /etc/system-release, or "" if it is missing (read once per process)"""
+    try:
+        return Path('/etc/system-release').read_text().strip()
+    except FileNotFoundError:
+        return ""
+
+# Installation steps, in order; each names an async ApacheInstaller method
+_STEPS = (
+    "check_system",
+    "tune_dnf",
+    "install_and_update",
+    "enable_and_start_apache",
+    "set_permissions",
+    "create_test_page",
+    "flush_script",
+    "check_apache_status",
+    "get_instance_info",
+)
+
 class ApacheInstaller:
     def __init__(self, dry_run=True):
         self.dry_run = dry_run
         self.steps = []
+        self._script_lines = []
+        self._ip_lookup = None
+        self._log_buf = io.StringIO()
+        # Absolute paths for the programs spawned directly, so exec skips the $PATH walk
+        self._sudo = shutil.which("sudo") or "sudo"
+        self._systemctl = shutil.which("systemctl") or "systemctl"
         
-    def log_step(self, description, command=None):
+    def _log(self, message=""):
+        """Buffer a line of output; written out by flush_log()"""
+        self._log_buf.write(message)
+        self._log_buf.write("\n")
+    
+    def flush_log(self):
+        """Write buffered output to stdout in one go"""
+        sys.stdout.write(self._log_buf.getvalue())
+        sys.stdout.flush()
+        self._log_buf.seek(0)
+        self._log_buf.truncate()
+    
+    def log_step(self, description, command=None, queued=False):
         """Log a step to be performed"""
         step_info = {"description": description, "command": command}
         self.steps.append(step_info)
         
         if self.dry_run:
-            print(f"[DRY RUN] {description}")
-            if command:
-                print(f"  Command: {command}")
+            self._log(f"[DRY RUN] {description}")
+        elif queued:
+            self._log(f"[QUEUED] {description}")
         else:
-            print(f"[EXECUTING] {description}")
-            if command:
-                print(f"  Command: {command}")
+            self._log(f"[EXECUTING] {description}")
+        if command:
+            self._log(f"  Command: {command}")
     
-    def run_command(self, command, description):
-        """Execute a command if not in dry run mode"""
-        self.log_step(description, command)
+    def run_command(self, argv, description, stdin=None, best_effort=False):
+        """Queue an argv command (with optional stdin text) for the root script if not in dry run mode
+        
+        A best_effort command only prints a warning on failure instead of stopping the script.
+        """
+        command = shlex.join(argv)
+        if stdin is None:
+            self.log_step(description, command, queued=True)
+        else:
+            self.log_step(description, f"{command} <<'END_OF_INPUT' ...", queued=True)
+            command = f"{command} <<'END_OF_INPUT'\n{stdin}\nEND_OF_INPUT"
+        if best_effort:
+            warning = shlex.quote(f"  ⚠ Skipped (not fatal): {description}")
+            command = f"{command} || echo {warning} >&2"
         
         if not self.dry_run:
-            try:
-                result = subprocess.run(
-                    command, 
-                    shell=True, 
-                    check=True, 
-                    capture_output=True, 
-                    text=True
-                )
-                print(f"  ✓ Success: {result.stdout.strip()}")
-                return result
-            except subprocess.CalledProcessError as e:
-                print(f"  ✗ Error: {e.stderr.strip()}")
-                return None
-        return True
+            self._script_lines.append((description, command))
     
-    def check_system(self):
+    async def flush_script(self):
+        """Run all queued commands as root in a single `sudo bash -c` invocation"""
+        if self.dry_run:
+            self.log_step("Running the queued commands above as root",
+                          "sudo bash -c '<queued commands>'")
+            return
+        if not self._script_lines:
+            return
+        
+        # The ERR trap names the step that failed; set -e stops the script there
+        lines = [
+            "set -euo pipefail",
+            "trap 'echo \"  ✗ Failed step: $step\" >&2' ERR",
+            # Expose $ID/$VERSION_ID so queued steps can branch without another Python-side read
+            "if [ -r /etc/os-release ]; then . /etc/os-release; fi",
+        ]
+        for description, command in self._script_lines:
+            lines.append(f"step={shlex.quote(description)}")
+            lines.append(command)
+        script = "\n".join(lines) + "\n"
+        count = len(self._script_lines)
+        self._script_lines = []
+        
+        self.log_step(f"Running {count} queued command(s) as root",
+                      "sudo bash -c '<queued commands>'")
+        # Pass the script as an argument so queued commands keep the caller's stdin
+        self.flush_log()  # keep our output ahead of the child's
+        process = await asyncio.create_subprocess_exec(self._sudo, 'bash', '-c', script)
+        returncode = await process.wait()
+        if returncode != 0:
+            self._log(f"  ✗ Error: script exited with status {returncode}")
+            raise subprocess.CalledProcessError(returncode, [self._sudo, 'bash', '-c', script])
+        self._log("  ✓ Success")
+    
+    async def check_system(self):
         """Check if running on Amazon Linux 2023"""
         self.log_step("Checking system version")
         
         if not self.dry_run:
-            try:
-                with open('/etc/system-release', 'r') as f:
-                    release_info = f.read().strip()
-                print(f"  System: {release_info}")
-                
-                if "Amazon Linux" not in release_info:
-                    print("  ⚠ Warning: This script is optimized for Amazon Linux")
-                    return True  # Still continue even if not Amazon Linux
-                else:
-                    print("  ✓ Amazon Linux detected - proceeding with installation")
-                    return True  # Success case
-                    
-            except FileNotFoundError:
-                print("  ⚠ Warning: Could not determine system version")
-                return True  # Continue anyway
-        
-        return True  # Always return True for dry run mode
-    
-    def update_system(self):
-        """Update system packages"""
-        return self.run_command(
-            "sudo dnf update -y",
+            release_info = _system_release()
+            # Only informational: the installation continues on any system
+            if not release_info:
+                self._log("  ⚠ Warning: Could not determine system version")
+            elif release_info.startswith("Amazon Linux"):
+                self._log(f"  System: {release_info}")
+                self._log("  ✓ Amazon Linux detected - proceeding with installation")
+            else:
+                self._log(f"  System: {release_info}")
+                self._log("  ⚠ Warning: This script is optimized for Amazon Linux")
+    
+    async def tune_dnf(self):
+        """Enable fastest mirror selection and parallel downloads for dnf"""
+        # config-manager edits the [main] section in place, so re-runs are idempotent
+        self.run_command(
+            ["dnf", "config-manager", "--save", "--setopt=fastestmirror=1",
+             "--setopt=max_parallel_downloads=10", "--setopt=deltarpm=0"],
+            "Tuning dnf (fastest mirror, parallel downloads)",
+            best_effort=True  # speed-only; dnf5 or a missing config-manager plugin must not stop the install
+        )
+
+    async def install_and_update(self):
+        """Update system packages and install Apache web server (httpd)"""
+        # Both run in the same root script; dnf's own exit codes stop it on failure
+        self.run_command(
+            ["dnf", "-y", "upgrade"],
             "Updating system packages"
         )
-    
-    def install_apache(self):
-        """Install Apache web server"""
-        return self.run_command(
-            "sudo dnf install -y httpd",
+        self.run_command(
+            ["dnf", "-y", "install", "httpd"],
             "Installing Apache web server (httpd)"
         )
     
-    def start_apache(self):
-        """Start Apache service"""
-        return self.run_command(
-            "sudo systemctl start httpd",
-            "Starting Apache web server"
+    async def enable_and_start_apache(self):
+        """Enable Apache to start on boot and start it now"""
+        self.run_command(
+            ["systemctl", "enable", "--now", "httpd"],
+            "Enabling and starting Apache web server"
         )
     
-    def enable_apache(self):
-        """Enable Apache to start on boot"""
-        return self.run_command(
-            "sudo systemctl enable httpd",
-            "Enabling Apache to start on boot"
-        )
-    
-    def check_apache_status(self):
+    async def check_apache_status(self):
         """Check Apache service status"""
-        return self.run_command(
-            "sudo systemctl status httpd --no-pager",
-            "Checking Apache service status"
-        )
+        argv = [self._systemctl, "status", "httpd", "--no-pager"]
+        self.log_step("Checking Apache service status", shlex.join(argv))
+        
+        if not self.dry_run:
+            # Read-only query, so it runs directly once the root script has finished
+            self.flush_log()  # keep our output ahead of the child's
+            process = await asyncio.create_subprocess_exec(*argv)
+            returncode = await process.wait()
+            if returncode != 0:
+                self._log(f"  ✗ Error: systemctl status exited with status {returncode}")
+                raise subprocess.CalledProcessError(returncode, argv)
+            self._log("  ✓ Apache is running")
     
-    def set_permissions(self):
+    async def set_permissions(self):
         """Set proper permissions for web directory"""
         commands = [
-            ("sudo usermod -a -G apache ec2-user", "Adding ec2-user to apache group"),
-            ("sudo chown -R ec2-user:apache /var/www", "Changing ownership of /var/www"),
-            ("sudo chmod 2775 /var/www", "Setting permissions on /var/www"),
-            ("find /var/www -type d -exec sudo chmod 2775 {} \\;", "Setting directory permissions"),
-            ("find /var/www -type f -exec sudo chmod 0664 {} \\;", "Setting file permissions")
+            (["usermod", "-a", "-G", "apache", "ec2-user"], "Adding ec2-user to apache group"),
+            (["chown", "-R", "ec2-user:apache", "/var/www"], "Changing ownership of /var/www"),
+            (["find", "/var/www", "-type", "d", "-exec", "chmod", "2775", "{}", "+",
+              "-o", "-type", "f", "-exec", "chmod", "0664", "{}", "+"],
+             "Setting recursive permissions")
         ]
         
-        for command, description in commands:
-            result = self.run_command(command, description)
-            if not result and not self.dry_run:
-                return False
-        return True
+        for argv, description in commands:
+            self.run_command(argv, description)
     
-    def create_test_page(self):
+    async def create_test_page(self):
         """Create a simple test HTML page"""
-        html_content = '''<!DOCTYPE html>
-<html>
-<head>
-    <title>Apache Test Page</title>
-</head>
-<body>
-    <h1>Apache Web Server is Running!</h1>
-    <p>Congratulations! Your Apache web server is successfully installed and running on Amazon Linux 2023.</p>
-    <p>Server time: <script>document.write(new Date());</script></p>
-</body>
-</html>'''
-        
-        self.log_step("Creating test HTML page", "echo 'HTML content' > /var/www/html/index.html")
-        
-        if not self.dry_run:
-            try:
-                with open('/var/www/html/index.html', 'w') as f:
-                    f.write(html_content)
-                print("  ✓ Test page created successfully")
-                return True
-            except Exception as e:
-                print(f"  ✗ Error creating test page: {e}")
-                return False
-        return True
+        # Written by the root script so the whole setup stays one sudo invocation
+        self.run_command(
+            ["cp", "/dev/stdin", "/var/www/html/index.html"],
+            "Creating test HTML page",
+            stdin=_INDEX_HTML
+        )
+    
+    def fetch_public_ip(self):
+        """Query instance metadata (IMDSv2) for the public IP; blocking, returns None if unset"""
+        # IMDSv2: fetch a session token, then the public IP over the same connection
+        conn = http.client.HTTPConnection("169.254.169.254", timeout=2)
+        try:
+            conn.request("PUT", "/latest/api/token",
+                         headers={"X-aws-ec2-metadata-token-ttl-seconds": "60"})
+            token_response = conn.getresponse()
+            token = token_response.read().decode()
+            if token_response.status != 200:
+                return None
+            conn.request("GET", "/latest/meta-data/public-ipv4",
+                         headers={"X-aws-ec2-metadata-token": token})
+            response = conn.getresponse()
+            public_ip = response.read().decode().strip()
+        finally:
+            conn.close()
+        return public_ip if response.status == 200 and public_ip else None
     
-    def get_instance_info(self):
+    async def get_instance_info(self):
         """Get EC2 instance public IP/DNS"""
         self.log_step("Getting instance public IP address")
         
         if not self.dry_run:
             try:
-                # Try to get public IP from instance metadata
-                result = subprocess.run(
-                    "curl -s http://169.254.169.254/latest/meta-data/public-ipv4",
-                    shell=True,
-                    capture_output=True,
-                    text=True,
-                    timeout=5
-                )
-                if result.returncode == 0 and result.stdout:
-                    public_ip = result.stdout.strip()
-                    print(f"  Public IP: {public_ip}")
-                    print(f"  Test your server at: http://{public_ip}")
-                    return True
+                # Normally already resolved: the lookup starts when the installation does
+                if self._ip_lookup is None:
+                    self._ip_lookup = asyncio.ensure_future(asyncio.to_thread(self.fetch_public_ip))
+                public_ip = await self._ip_lookup
+                
+                if public_ip:
+                    self._log(f"  Public IP: {public_ip}")
+                    self._log(f"  Test your server at: http://{public_ip}")
                 else:
-                    print("  Could not retrieve public IP address")
-                    return True  # Not a critical failure
+                    self._log("  Could not retrieve public IP address")
             except Exception as e:
-                print(f"  Error getting instance info: {e}")
-                return True  # Not a critical failure
-        return True
+                # Not a critical failure; this step must never stop the run
+                self._log(f"  Error getting instance info: {e}")
     
-    def install_complete_setup(self):
+    async def install_complete_setup(self):
         """Run the complete Apache installation process"""
-        print("=" * 60)
-        print("Apache Web Server Installation Script")
-        print("=" * 60)
+        try:
+            return await self._install_steps()
+        finally:
+            self.flush_log()
+    
+    async def _install_steps(self):
+        """Log the banner and run each step in _STEPS"""
+        self._log("=" * 60)
+        self._log("Apache Web Server Installation Script")
+        self._log("=" * 60)
         
         if self.dry_run:
-            print("DRY RUN MODE - No changes will be made")
-            print("Use --apply flag to actually perform installation")
+            self._log("DRY RUN MODE - No changes will be made")
+            self._log("Use --apply flag to actually perform installation")
         else:
-            print("INSTALLATION MODE - Changes will be applied")
+            self._log("INSTALLATION MODE - Changes will be applied")
             
             # Check if running as root or with sudo
-            if os.geteuid() != 0:
-                print("⚠ Warning: This script should be run with sudo privileges")
-                print("Example: sudo python3 apache_installer.py --apply")
-        
-        print("-" * 60)
-        
-        # Execute installation steps
-        steps = [
-            self.check_system,
-            self.update_system,
-            self.install_apache,
-            self.start_apache,
-            self.enable_apache,
-            self.set_permissions,
-            self.create_test_page,
-            self.check_apache_status,
-            self.get_instance_info
-        ]
+            if not _is_root():
+                self._log("⚠ Warning: This script should be run with sudo privileges")
+                self._log("Example: sudo python3 apache_installer.py --apply")
+        
+        if self.dry_run:
+            self._log("Commands up to 'Running the queued commands' run in one root script (sudo bash -c)")
+        else:
+            self._log("Setup commands are queued and run together in one root script (sudo bash -c)")
+        self._log("-" * 60)
+        
+        if not self.dry_run:
+            # The metadata lookup doesn't depend on any step, so overlap it with the install
+            self._ip_lookup = asyncio.ensure_future(asyncio.to_thread(self.fetch_public_ip))
         
-        for step in steps:
-            result = step()
-            if not result and not self.dry_run:
-                print(f"✗ Installation failed at step: {step.__name__}")
-                return False
-            print()
+        # Execute installation steps; the root script's set -e stops at the first failing command
+        try:
+            for name in _STEPS:
+                await getattr(self, name)()
+                self._log()
+        except subprocess.CalledProcessError:
+            if name == "flush_script":
+                # The script's ERR trap has already named the queued step that failed
+                self._log("✗ Installation failed (see the failed step above)")
+            else:
+                self._log(f"✗ Installation failed at step: {name}")
+            if self._ip_lookup is not None and not self._ip_lookup.cancel():
+                self._ip_lookup.exception()  # already finished; mark any error as retrieved
+            return False
         
-        print("=" * 60)
+        self._log("=" * 60)
         if self.dry_run:
-            print("DRY RUN COMPLETED")
-            print("Run with --apply to perform actual installation")
+            self._log("DRY RUN COMPLETED")
+            self._log("Run with --apply to perform actual installation")
         else:
-            print("INSTALLATION COMPLETED SUCCESSFULLY!")
-            print("Your Apache web server should now be running")
-            print("Make sure your EC2 security group allows HTTP traffic on port 80")
-        print("=" * 60)
+            self._log("INSTALLATION COMPLETED SUCCESSFULLY!")
+            self._log("Your Apache web server should now be running")
+            self._log("Make sure your EC2 security group allows HTTP traffic on port 80")
+        self._log("=" * 60)
         
         return True
 
@@ -239,7 +336,7 @@ def main():
     args = parser.parse_args()
     
     installer = ApacheInstaller(dry_run=not args.apply)
-    installer.install_complete_setup()
+    asyncio.run(installer.install_complete_setup())
 
 if __name__ == "__main__":
     main()